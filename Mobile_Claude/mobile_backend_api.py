@@ -4,23 +4,38 @@
 import os
 from dotenv import load_dotenv
 load_dotenv()
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Optional
 import anthropic
+import asyncio
 import base64
+import binascii
+import hashlib
+import io
 from datetime import datetime, timedelta
 from dateutil.parser import parse as date_parser
-import json
+import orjson
 import re
 import stripe
 from jose import JWTError, jwt
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 import os
+import time
+import uuid
 from enum import Enum
+from functools import lru_cache
+from cachetools import TTLCache
+from PIL import ExifTags, Image, ImageOps
 
 # Initialize FastAPI app
-app = FastAPI(title="Flyer to Calendar API", version="1.0.0")
+app = FastAPI(
+    title="Flyer to Calendar API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
 
 # CORS configuration for mobile apps
 app.add_middleware(
@@ -36,11 +51,28 @@ ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 STRIPE_API_KEY = os.getenv("STRIPE_API_KEY")
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-here")
 JWT_ALGORITHM = "HS256"
+# ANTHROPIC_MODEL = "claude-3-sonnet-20241022"
+ANTHROPIC_MODEL = "claude-sonnet-4-20250514"
+ANTHROPIC_MAX_CONCURRENCY = int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", "8"))
+ANTHROPIC_MAX_RPS = float(os.getenv("ANTHROPIC_MAX_RPS", "4"))
+MAX_IMAGE_EDGE = 1024  # px; larger uploads are downscaled before going to Claude
+CLAUDE_IMAGE_FORMATS = ("JPEG", "PNG", "GIF", "WEBP")  # anything else is re-encoded to JPEG
 
 # Initialize clients
-anthropic_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+# Retries are handled by _retry_transient below, not the SDK
+anthropic_client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, max_retries=0)
 stripe.api_key = STRIPE_API_KEY
 
+# Date/time shapes the LLM usually returns; tried with strptime before falling
+# back to dateutil's (much slower) fuzzy parser.
+DATE_FORMATS = ("%B %d %Y", "%b %d %Y", "%B %d, %Y", "%b %d, %Y", "%m/%d/%Y", "%Y-%m-%d")
+# Year-less dates ("September 5") are retried with the current year appended;
+# strptime without a year is deprecated from Python 3.13
+YEARLESS_DATE_FORMATS = ("%B %d %Y", "%b %d %Y")
+TIME_FORMATS = ("%I:%M %p", "%I %p", "%H:%M")
+
+_JSON_OBJ_RE = re.compile(r'\{.*\}', re.DOTALL)
+
 # --- Data Models ---
 
 class SubscriptionTier(str, Enum):
@@ -59,7 +91,7 @@ class User(BaseModel):
 
 class ImageRequest(BaseModel):
     image_base64: str
-    image_type: str = "image/jpeg"  # or "image/png"
+    image_type: str = "image/jpeg"  # accepted for older clients; the type is detected from the bytes
 
 class Event(BaseModel):
     title: str
@@ -111,12 +143,76 @@ def check_scan_limits(user):
             return False, "Free trial limit reached. Please upgrade to continue."
     return True, "OK"
 
+# --- Rate Limiting ---
+
+class TokenBucket:
+    """Async token bucket: allows `rate` acquisitions per second, bursting up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# Caps in-flight Anthropic calls per worker and their request rate
+_API_SEM = asyncio.Semaphore(ANTHROPIC_MAX_CONCURRENCY)
+_API_RATE = TokenBucket(ANTHROPIC_MAX_RPS)
+# Caps image decode/resize work running in threads at once
+_IMAGE_SEM = asyncio.BoundedSemaphore(os.cpu_count() or 4)
+
+# --- Upstream Retries ---
+
+_RETRYABLE_STATUS = {429, 500, 502, 503, 529}
+
+def _is_transient(exc: BaseException) -> bool:
+    """True for upstream errors worth retrying: throttling, 5xx and dropped connections"""
+    if isinstance(exc, (anthropic.APIConnectionError, stripe.error.APIConnectionError)):
+        return True
+    if isinstance(exc, stripe.error.StripeError):
+        # Stripe replays the stored response (5xx included) for a reused idempotency
+        # key, so only throttling can succeed on another attempt
+        return exc.http_status == 429
+    return getattr(exc, "status_code", None) in _RETRYABLE_STATUS
+
+_retry_transient = retry(
+    retry=retry_if_exception(_is_transient),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+
+@_retry_transient
+async def _create_message(**kwargs):
+    """anthropic_client.messages.create, rate limited and retried on transient errors"""
+    async with _API_SEM:
+        await _API_RATE.acquire()
+        return await anthropic_client.messages.create(**kwargs)
+
+@_retry_transient
+async def _stripe_create(create, **params):
+    """Run a Stripe create call off the event loop, retried on transient errors.
+    Callers must pass an idempotency_key so a retry can never double-charge."""
+    return await asyncio.to_thread(create, **params)
+
 # --- Core Event Extraction ---
 
-def extract_events_from_image(image_base64: str, image_type: str) -> List[Event]:
-    """Extract multiple events from image using Anthropic Claude"""
-    
-    prompt = """
+# Extraction results keyed on (sha256 of the uploaded image, model), so a
+# re-uploaded or retried flyer doesn't go back to Claude
+_EXTRACTION_CACHE = TTLCache(maxsize=1024, ttl=86400)
+
+_EXTRACT_PROMPT = """
     Analyze this image and identify ALL individual events mentioned. This could be an email, flyer, or document with multiple dates and events listed.
     
     Extract EACH event as a separate item. Return a JSON object with a single key "events" containing an array of event objects.
@@ -132,62 +228,156 @@ def extract_events_from_image(image_base64: str, image_type: str) -> List[Event]
     Important: Create a SEPARATE event object for EACH date mentioned.
     Return ONLY the JSON object, no other text.
     """
+_PROMPT_BLOCK = {"type": "text", "text": _EXTRACT_PROMPT}
+
+def _image_messages(media_type: str, data: str) -> list:
+    """Messages payload for one base64 image followed by the shared extraction prompt"""
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": data,
+                    },
+                },
+                _PROMPT_BLOCK,
+            ],
+        }
+    ]
+
+def downscale_image(image_data: bytes) -> tuple:
+    """Shrink images larger than MAX_IMAGE_EDGE to a JPEG; returns (image_data, image_type).
+    Small images pass through, typed by the format PIL detects rather than the client's
+    claimed content type (mobile clients often send application/octet-stream)."""
+    image = Image.open(io.BytesIO(image_data))
+    # Phone photos are stored in sensor orientation plus an EXIF tag that the JPEG
+    # re-encode drops, so rotated ones always get turned upright and re-encoded.
+    # Only JPEG/WebP carry it in their headers; getexif() on a PNG decodes the image.
+    rotated = (image.format in ("JPEG", "WEBP")
+               and image.getexif().get(ExifTags.Base.Orientation, 1) != 1)
+    if not rotated and max(image.size) <= MAX_IMAGE_EDGE and image.format in CLAUDE_IMAGE_FORMATS:
+        return image_data, Image.MIME[image.format]
+    
+    if rotated:
+        image = ImageOps.exif_transpose(image)
+    # Pillow silently resizes "P" and "1" images with NEAREST whatever filter is asked
+    # for, which breaks up text; resample in RGB(A) instead
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+    elif image.mode in ("P", "1"):
+        image = image.convert("RGB")
+    image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+    if image.mode == "RGBA":
+        # Transparent pixels usually store black; flatten onto white so dark text stays readable
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    buffered = io.BytesIO()
+    image.convert("RGB").save(buffered, format="JPEG", quality=85)
+    return buffered.getvalue(), "image/jpeg"
+
+def _prepare_image(image_data: bytes) -> tuple:
+    """Downscale and base64-encode an upload; CPU-bound, so run it off the event loop"""
+    image_data, image_type = downscale_image(image_data)
+    # The messages API only takes base64 image sources, so encode exactly once here
+    return base64.b64encode(image_data).decode("ascii"), image_type
+
+async def extract_events_from_image(image_data: bytes) -> List[Event]:
+    """Extract multiple events from raw image bytes using Anthropic Claude"""
+    
+    cache_key = (hashlib.sha256(image_data).hexdigest(), ANTHROPIC_MODEL)
+    cached = _EXTRACTION_CACHE.get(cache_key)
+    if cached is not None:
+        return list(cached)
     
     try:
-        response = anthropic_client.messages.create(
-            # model="claude-3-sonnet-20241022",
-            model="claude-sonnet-4-20250514",
+        async with _IMAGE_SEM:
+            image_base64, image_type = await asyncio.to_thread(_prepare_image, image_data)
+        response = await _create_message(
+            model=ANTHROPIC_MODEL,
             max_tokens=2048,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": image_type,
-                                "data": image_base64,
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ],
-                }
-            ],
+            messages=_image_messages(image_type, image_base64),
         )
         
         response_text = response.content[0].text
-        json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
+        json_match = _JSON_OBJ_RE.search(response_text)
         
         if json_match:
-            data = json.loads(json_match.group(0))
-            events = data.get("events", [])
-            return [Event(**event) for event in events]
+            data = orjson.loads(json_match.group(0))
+            # Claude's JSON is untrusted: validate here, inside the try, so a bad reply
+            # becomes a detailed error and never lands in the cache
+            events = [Event.model_validate(event) for event in data.get("events", [])]
+            if events:
+                _EXTRACTION_CACHE[cache_key] = events
+            return events
         
         return []
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
+@lru_cache(maxsize=4096)
+def _cached_parse(s: str, fuzzy: bool = False, default: Optional[datetime] = None) -> datetime:
+    """dateutil parse, memoized on the raw string (flyers repeat the same dates)"""
+    return date_parser(s, fuzzy=fuzzy, default=default)
+
+def _try_strptime(s: str, fmts: tuple) -> datetime:
+    """Return the first successful strptime parse of s, else raise ValueError"""
+    s = s.strip()
+    for fmt in fmts:
+        try:
+            return datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"no format matched {s!r}")
+
+def _parse_event_date(date_str: str) -> datetime:
+    """Parse an event date, trying ISO-8601 and the common formats before dateutil"""
+    try:
+        return datetime.fromisoformat(date_str)
+    except ValueError:
+        pass
+    
+    try:
+        return _try_strptime(date_str, DATE_FORMATS)
+    except ValueError:
+        pass
+    
+    # Dates without a year get the current one: appended for strptime, and
+    # supplied through the default for dateutil
+    current_year = datetime.now().year
+    try:
+        return _try_strptime(f"{date_str.strip()} {current_year}", YEARLESS_DATE_FORMATS)
+    except ValueError:
+        return _cached_parse(date_str, fuzzy=True, default=datetime(current_year, 1, 1))
+
+def _parse_time_on(event_date: datetime, time_str: str) -> datetime:
+    """Place a time string such as "7:30 PM" on event_date's day"""
+    try:
+        # Already a full timestamp (e.g. a re-submitted /events/format-for-calendar result)
+        return datetime.fromisoformat(time_str)
+    except ValueError:
+        pass
+    try:
+        t = _try_strptime(time_str, TIME_FORMATS)
+    except ValueError:
+        # dateutil takes any fields missing from time_str (the date) from the default
+        return _cached_parse(time_str, fuzzy=True, default=event_date)
+    return datetime.combine(event_date.date(), t.time())
+
 def parse_event_datetime(event: Event) -> tuple:
     """Convert event date/time to ISO format datetime strings"""
-    current_year = datetime.now().year
-    
     try:
-        date_str = event.date
-        if not re.search(r'\d{4}', date_str):
-            date_str = f"{date_str} {current_year}"
-        
-        event_date = date_parser(date_str, fuzzy=True)
+        event_date = _parse_event_date(event.date)
         
         # Parse start time
         if event.start_time:
             try:
-                start_datetime_str = f"{event_date.strftime('%Y-%m-%d')} {event.start_time}"
-                start_datetime = date_parser(start_datetime_str, fuzzy=True)
+                start_datetime = _parse_time_on(event_date, event.start_time)
             except:
                 start_datetime = event_date.replace(hour=9, minute=0)
         else:
@@ -196,8 +386,7 @@ def parse_event_datetime(event: Event) -> tuple:
         # Parse end time
         if event.end_time:
             try:
-                end_datetime_str = f"{event_date.strftime('%Y-%m-%d')} {event.end_time}"
-                end_datetime = date_parser(end_datetime_str, fuzzy=True)
+                end_datetime = _parse_time_on(event_date, event.end_time)
             except:
                 end_datetime = start_datetime + timedelta(hours=1)
         else:
@@ -217,15 +406,11 @@ async def root():
     return {
         "message": "Flyer to Calendar API",
         "version": "1.0.0",
-        "endpoints": ["/extract-events", "/subscribe", "/user/profile"]
+        "endpoints": ["/extract-events", "/extract-events/binary", "/subscribe", "/user/profile"]
     }
 
-@app.post("/extract-events", response_model=EventsResponse)
-async def extract_events(
-    request: ImageRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """Extract events from uploaded image"""
+async def _extract_events_response(image_data: bytes, current_user: dict) -> EventsResponse:
+    """Shared body of the JSON and binary extract endpoints"""
     
     # Check subscription limits
     can_scan, message = check_scan_limits(current_user)
@@ -234,7 +419,7 @@ async def extract_events(
     
     # Process the image
     start_time = datetime.now()
-    events = extract_events_from_image(request.image_base64, request.image_type)
+    events = await extract_events_from_image(image_data)
     processing_time = (datetime.now() - start_time).total_seconds()
     
     # Increment scan count for free users
@@ -243,12 +428,36 @@ async def extract_events(
         # Update scan count in database
         pass
     
-    return EventsResponse(
+    return EventsResponse.model_construct(
         events=events,
         total_events=len(events),
         processing_time=processing_time
     )
 
+@app.post("/extract-events", response_model=EventsResponse)
+async def extract_events(
+    request: ImageRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Extract events from uploaded image"""
+    
+    try:
+        image_data = base64.b64decode(request.image_base64)
+    except binascii.Error:
+        raise HTTPException(status_code=400, detail="image_base64 is not valid base64")
+    
+    return await _extract_events_response(image_data, current_user)
+
+@app.post("/extract-events/binary", response_model=EventsResponse)
+async def extract_events_binary(
+    file: UploadFile = File(...),
+    current_user: dict = Depends(get_current_user)
+):
+    """Extract events from an image sent as multipart/form-data (no base64 on the wire)"""
+    
+    image_data = await file.read()
+    return await _extract_events_response(image_data, current_user)
+
 @app.post("/events/format-for-calendar")
 async def format_for_calendar(
     events: List[Event],
@@ -257,9 +466,15 @@ async def format_for_calendar(
     """Convert events to calendar-ready format with ISO datetimes"""
     
     calendar_events = []
+    # Shared flyers repeat events; parse each distinct date/time combination once
+    parsed = {}
     for event in events:
-        start_dt, end_dt = parse_event_datetime(event)
-        calendar_events.append(CalendarEvent(
+        key = (event.date, event.start_time, event.end_time)
+        if key not in parsed:
+            parsed[key] = parse_event_datetime(event)
+        start_dt, end_dt = parsed[key]
+        # Built from already-validated input, so skip re-validation
+        calendar_events.append(CalendarEvent.model_construct(
             title=event.title,
             start_datetime=start_dt,
             end_datetime=end_dt,
@@ -284,21 +499,28 @@ async def subscribe(
             SubscriptionTier.LIFETIME: "price_lifetime_199" # $199 one-time
         }
         
+        # Shared by every retry of this purchase so Stripe only applies it once
+        idempotency_key = str(uuid.uuid4())
+        
         if request.plan == SubscriptionTier.LIFETIME:
             # One-time payment
-            payment = stripe.PaymentIntent.create(
+            payment = await _stripe_create(
+                stripe.PaymentIntent.create,
                 amount=19900,  # $199.00 in cents
                 currency="usd",
                 payment_method=request.payment_token,
-                confirm=True
+                confirm=True,
+                idempotency_key=idempotency_key
             )
         else:
             # Recurring subscription
-            subscription = stripe.Subscription.create(
+            subscription = await _stripe_create(
+                stripe.Subscription.create,
                 customer=current_user["id"],  # Assumes Stripe customer exists
                 items=[{"price": price_ids[request.plan]}],
                 payment_method=request.payment_token,
-                expand=["latest_invoice.payment_intent"]
+                expand=["latest_invoice.payment_intent"],
+                idempotency_key=idempotency_key
             )
         
         # Update user subscription in database
@@ -368,4 +590,6 @@ async def health_check():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # uvloop + httptools come with uvicorn[standard]. In production, run several workers:
+    #   uvicorn mobile_backend_api:app --loop uvloop --http httptools --workers 4
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools")
\ No newline at end of file
@@ -1,14 +1,22 @@
-import requests
+import asyncio
 import base64
+import httpx
 import json
+import time
 from PIL import Image
 import io
+from functools import lru_cache
 
 # API base URL
 BASE_URL = "http://localhost:8000"
 
-def create_test_image():
-    """Create a simple test image with event text"""
+# Concurrent extract scenario (Test 7)
+LOAD_TEST_REQUESTS = 5
+LOAD_TEST_CONCURRENCY = 3
+
+@lru_cache(maxsize=None)
+def _build_test_image_bytes(tag=""):
+    """Render the test flyer once per tag and return it as PNG bytes"""
     from PIL import Image, ImageDraw, ImageFont
     
     # Create a white image
@@ -39,28 +47,32 @@ def create_test_image():
         font = ImageFont.load_default()
     
     draw.text((50, 50), text, fill='black', font=font)
+    if tag:
+        # Different pixels, so the API's extraction cache can't answer for this image
+        draw.text((50, 550), tag, fill='black', font=font)
     
-    # Convert to base64
     buffered = io.BytesIO()
     img.save(buffered, format="PNG")
-    img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    
-    return img_base64
+    return buffered.getvalue()
 
-def test_health_check():
+def create_test_image(tag=""):
+    """Create a simple test image with event text (plus an optional distinguishing tag)"""
+    return base64.b64encode(_build_test_image_bytes(tag)).decode('utf-8')
+
+async def test_health_check(client):
     """Test 1: Check if API is running"""
     print("Test 1: Health Check")
-    response = requests.get(f"{BASE_URL}/health")
+    response = await client.get("/health")
     print(f"Status Code: {response.status_code}")
     print(f"Response: {json.dumps(response.json(), indent=2)}")
     print("-" * 50)
     return response.status_code == 200
 
-def test_registration():
+async def test_registration(client):
     """Test 2: Register a new user"""
     print("Test 2: User Registration")
-    response = requests.post(
-        f"{BASE_URL}/auth/register",
+    response = await client.post(
+        "/auth/register",
         params={"email": "test@example.com", "password": "testpass123"}
     )
     print(f"Status Code: {response.status_code}")
@@ -69,11 +81,11 @@ def test_registration():
     print("-" * 50)
     return data.get("access_token")
 
-def test_login():
+async def test_login(client):
     """Test 3: Login"""
     print("Test 3: User Login")
-    response = requests.post(
-        f"{BASE_URL}/auth/login",
+    response = await client.post(
+        "/auth/login",
         params={"email": "test@example.com", "password": "testpass123"}
     )
     print(f"Status Code: {response.status_code}")
@@ -82,7 +94,7 @@ def test_login():
     print("-" * 50)
     return data.get("access_token")
 
-def test_extract_events(token):
+async def test_extract_events(client, token):
     """Test 4: Extract events from image"""
     print("Test 4: Extract Events from Image")
     
@@ -96,8 +108,8 @@ def test_extract_events(token):
         "image_type": "image/png"
     }
     
-    response = requests.post(
-        f"{BASE_URL}/extract-events",
+    response = await client.post(
+        "/extract-events",
         json=payload,
         headers=headers
     )
@@ -119,14 +131,14 @@ def test_extract_events(token):
         return None
     print("-" * 50)
 
-def test_calendar_format(token, events):
+async def test_calendar_format(client, token, events):
     """Test 5: Format events for calendar"""
     print("\nTest 5: Format Events for Calendar")
     
     headers = {"Authorization": f"Bearer {token}"}
     
-    response = requests.post(
-        f"{BASE_URL}/events/format-for-calendar",
+    response = await client.post(
+        "/events/format-for-calendar",
         json=events,
         headers=headers
     )
@@ -143,52 +155,88 @@ def test_calendar_format(token, events):
         print(f"Error: {response.text}")
     print("-" * 50)
 
-def test_user_profile(token):
+async def test_user_profile(client, token):
     """Test 6: Get user profile"""
     print("Test 6: Get User Profile")
     
     headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{BASE_URL}/user/profile", headers=headers)
+    response = await client.get("/user/profile", headers=headers)
     
     print(f"Status Code: {response.status_code}")
     print(f"Response: {json.dumps(response.json(), indent=2)}")
     print("-" * 50)
 
-def run_all_tests():
+async def test_concurrent_extract(client, token, n=LOAD_TEST_REQUESTS):
+    """Test 7: Fire several extract requests at once, each with its own image"""
+    print(f"Test 7: {n} Concurrent Extract Requests")
+    
+    headers = {"Authorization": f"Bearer {token}"}
+    # A unique image per request (and per run), so every one goes to Claude
+    # instead of being answered by the server's extraction cache
+    run_id = int(time.time())
+    payloads = [
+        {
+            "image_base64": create_test_image(f"Load test {run_id} #{i}"),
+            "image_type": "image/png"
+        }
+        for i in range(n)
+    ]
+    # Keep the burst under the API's rate limits
+    sem = asyncio.Semaphore(LOAD_TEST_CONCURRENCY)
+    
+    async def extract_once(payload):
+        async with sem:
+            response = await client.post("/extract-events", json=payload, headers=headers)
+            return response.status_code
+    
+    started = time.perf_counter()
+    status_codes = await asyncio.gather(*[extract_once(payload) for payload in payloads])
+    elapsed = time.perf_counter() - started
+    
+    print(f"Status Codes: {status_codes}")
+    print(f"Wall Time: {elapsed:.2f} seconds")
+    print("-" * 50)
+    return all(code == 200 for code in status_codes)
+
+async def run_all_tests():
     """Run all tests in sequence"""
     print("=" * 50)
     print("FLYER TO CALENDAR API TESTS")
     print("=" * 50)
     
-    # Test 1: Health check
-    if not test_health_check():
-        print("❌ API is not running. Please start it first!")
-        return
-    
-    # Test 2 & 3: Auth
-    token = test_registration()
-    if not token:
-        token = test_login()
-    
-    if not token:
-        print("❌ Authentication failed!")
-        return
-    
-    print(f"✅ Got auth token: {token[:20]}...")
-    
-    # Test 4: Extract events
-    events = test_extract_events(token)
-    
-    # Test 5: Format for calendar (only if we got events)
-    if events:
-        test_calendar_format(token, events)
-    
-    # Test 6: User profile
-    test_user_profile(token)
-    
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=120.0) as client:
+        # Test 1: Health check
+        if not await test_health_check(client):
+            print("❌ API is not running. Please start it first!")
+            return
+        
+        # Test 2 & 3: Auth
+        token = await test_registration(client)
+        if not token:
+            token = await test_login(client)
+        
+        if not token:
+            print("❌ Authentication failed!")
+            return
+        
+        print(f"✅ Got auth token: {token[:20]}...")
+        
+        # Test 4: Extract events
+        events = await test_extract_events(client, token)
+        
+        # Test 5: Format for calendar (only if we got events)
+        if events:
+            await test_calendar_format(client, token, events)
+        
+        # Test 6: User profile
+        await test_user_profile(client, token)
+        
+        # Test 7: Concurrent extraction
+        await test_concurrent_extract(client, token)
+        
     print("\n" + "=" * 50)
     print("✅ ALL TESTS COMPLETED")
     print("=" * 50)
 
 if __name__ == "__main__":
-    run_all_tests()
\ No newline at end of file
+    asyncio.run(run_all_tests())
\ No newline at end of file
@@ -1,19 +1,42 @@
 import streamlit as st
-from PIL import Image
-from ics import Calendar, Event
+from PIL import ExifTags, Image, ImageOps
 from datetime import datetime, timedelta
 from dateutil.parser import parse as date_parser
-import json
+import orjson
 import fitz  # PyMuPDF
 import io
 import re
 import anthropic
 import base64
+import uuid
 from datetime import datetime
+from functools import lru_cache
 import pytz
 
 CURRENT_YEAR = datetime.now().year
 DEFAULT_TZ = pytz.timezone("US/Eastern")
+MAX_IMAGE_EDGE = 1024  # px; larger flyers are downscaled before going to Claude
+PDF_DPI = 150  # plenty for a MAX_IMAGE_EDGE-sized image
+
+_JSON_ARR_RE = re.compile(r'\[.*\]', re.DOTALL)
+_SLUG_NONWORD = re.compile(r'[^\w\s-]')
+_SLUG_DASH = re.compile(r'[-\s]+')
+
+# Minimal single-event RFC 5545 calendar; times are written in UTC
+_ICS_TEMPLATE = (
+    "BEGIN:VCALENDAR\r\n"
+    "VERSION:2.0\r\n"
+    "PRODID:-//flyer2cal//EN\r\n"
+    "BEGIN:VEVENT\r\n"
+    "UID:{uid}@flyer2cal\r\n"
+    "DTSTAMP:{stamp:%Y%m%dT%H%M%SZ}\r\n"
+    "DTSTART:{begin:%Y%m%dT%H%M%SZ}\r\n"
+    "DTEND:{end:%Y%m%dT%H%M%SZ}\r\n"
+    "{summary}{location}{description}"
+    "END:VEVENT\r\n"
+    "END:VCALENDAR\r\n"
+)
+_ICS_ESCAPES = str.maketrans({"\\": "\\\\", ";": "\\;", ",": "\\,", "\n": "\\n", "\r": ""})
 
 # --- Configuration ---
 st.set_page_config(layout="wide", page_title="Flyer to Calendar", page_icon="📅")
@@ -32,20 +55,106 @@ except Exception as e:
 
 # --- Core Functions ---
 
+_EXTRACT_PROMPT = """
+        Analyze the flyer image and extract ALL distinct event details.
+        Return ONLY a JSON array of objects with the keys:
+        "title", "start_time", "end_time", "location", "description".
+
+        Rules:
+        - start_time and end_time MUST be full ISO 8601 datetime strings, including year, month, day, and time (e.g. "2025-11-07T14:00:00-06:00").
+        - If the flyer only says a weekday (e.g. "Friday"), resolve it to the *next upcoming* date for that weekday, assuming the current year.
+        - If the flyer only lists month/day (e.g. "Nov 7"), add the current year.
+        - Never output times without a date.
+        """
+_PROMPT_BLOCK = {"type": "text", "text": _EXTRACT_PROMPT}
+
+
+def _image_messages(media_type: str, data: str) -> list:
+    """Builds the messages payload: one base64 image followed by the shared prompt."""
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": data,
+                    },
+                },
+                _PROMPT_BLOCK,
+            ],
+        }
+    ]
+
+
+@lru_cache(maxsize=4096)
+def _cached_parse(s: str, fuzzy: bool = False, default: datetime = None) -> datetime:
+    """dateutil parse, memoized on the raw string (flyers repeat the same dates)."""
+    return date_parser(s, fuzzy=fuzzy, default=default)
+
+
+def _parse_datetime(s: str, default: datetime = None) -> datetime:
+    """Parses ISO-8601 with the C fast path, falling back to (cached) dateutil."""
+    try:
+        return datetime.fromisoformat(s)
+    except (TypeError, ValueError):
+        return _cached_parse(s, default=default)
+
+
 def image_to_base64(image: Image.Image):
     """
     Converts a PIL Image to a base64 encoded string and determines the correct media type.
+    Images larger than MAX_IMAGE_EDGE are downscaled first (into a new image, so the
+    displayed flyer keeps its full resolution).
     """
+    # Phone photos are stored in sensor orientation plus an EXIF tag, which the
+    # re-encode below drops; apply it first (only rotated photos pay for the copy)
+    if image.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+        image = ImageOps.exif_transpose(image)
+
+    if max(image.size) > MAX_IMAGE_EDGE:
+        # Pillow silently resizes "P" and "1" images with NEAREST whatever filter is
+        # asked for, which breaks up text; resample in RGB(A) instead
+        if image.mode == "P":
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        elif image.mode == "1":
+            image = image.convert("L")
+        # resize() allocates only the small target, unlike copy() + thumbnail()
+        scale = MAX_IMAGE_EDGE / max(image.size)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.Resampling.LANCZOS)
+
     buffered = io.BytesIO()
     media_type = ""
     if image.mode in ("RGBA", "P"):
         image.save(buffered, format="PNG")
         media_type = "image/png"
     else:
-        image.save(buffered, format="JPEG")
+        image.save(buffered, format="JPEG", quality=85)
         media_type = "image/jpeg"
-        
-    return base64.b64encode(buffered.getvalue()).decode("utf-8"), media_type
+
+    # Encode straight from the buffer's memory; getvalue() would copy the whole image first
+    with buffered.getbuffer() as view:
+        image_b64 = base64.b64encode(view).decode("utf-8")
+    return image_b64, media_type
+
+
+PDF_CACHE_SIZE = 64  # each entry is a full page raster (~6 MB at 150 dpi for letter size)
+
+
+@st.cache_data(show_spinner=False, max_entries=PDF_CACHE_SIZE)
+def render_pdf_first_page(pdf_bytes: bytes):
+    """
+    Rasterizes the first page of a PDF, or returns None if it has no pages.
+    Cached on the file contents, so Streamlit reruns don't render it again.
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        if pdf_document.page_count == 0:
+            return None
+        pix = pdf_document[0].get_pixmap(dpi=PDF_DPI)
+        return Image.open(io.BytesIO(pix.tobytes("png")))
 
 
 def get_anthropic_response_for_multiple_events(image: Image.Image):
@@ -56,56 +165,26 @@ def get_anthropic_response_for_multiple_events(image: Image.Image):
     try:
         image_b64, media_type = image_to_base64(image)
 
-        prompt = """
-        Analyze the flyer image and extract ALL distinct event details.
-        Return ONLY a JSON array of objects with the keys:
-        "title", "start_time", "end_time", "location", "description".
-
-        Rules:
-        - start_time and end_time MUST be full ISO 8601 datetime strings, including year, month, day, and time (e.g. "2025-11-07T14:00:00-06:00").
-        - If the flyer only says a weekday (e.g. "Friday"), resolve it to the *next upcoming* date for that weekday, assuming the current year.
-        - If the flyer only lists month/day (e.g. "Nov 7"), add the current year.
-        - Never output times without a date.
-        """
-
         response = client.messages.create(
             model="claude-sonnet-4-20250514", 
             max_tokens=2048,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": media_type,
-                                "data": image_b64,
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ],
-                }
-            ],
+            messages=_image_messages(media_type, image_b64),
         )
 
         response_text = response.content[0].text
 
         # Extract JSON array
-        json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
+        json_match = _JSON_ARR_RE.search(response_text)
         if json_match:
             try:
-                events_list = json.loads(json_match.group(0))
+                events_list = orjson.loads(json_match.group(0))
                 if isinstance(events_list, list) and all(isinstance(item, dict) for item in events_list):
                     return events_list
                 else:
                     st.error("API response is not a valid list of event objects.")
                     st.code(response_text, language="text")
                     return []
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 st.error("Could not parse the extracted JSON array.")
                 st.code(response_text, language="text")
                 return []
@@ -119,15 +198,36 @@ def get_anthropic_response_for_multiple_events(image: Image.Image):
         return []
 
 
+def _ics_text(name: str, value) -> str:
+    """
+    Builds an escaped TEXT property line (with its CRLF), folded at 75 octets per
+    RFC 5545 without splitting a UTF-8 sequence. Empty values yield no line at all.
+    """
+    if not value:
+        return ""
+    raw = f"{name}:{str(value).translate(_ICS_ESCAPES)}".encode("utf-8")
+    parts, limit = [], 75
+    while len(raw) > limit:
+        cut = limit
+        while (raw[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(raw[:cut].decode("utf-8"))
+        raw = raw[cut:]
+        limit = 74  # continuation lines start with a space
+    parts.append(raw.decode("utf-8"))
+    return "\r\n ".join(parts) + "\r\n"
+
+
 def create_ics_file(event_data: dict) -> str:
-    c = Calendar()
-    e = Event()
-    e.name = event_data.get('title', 'Untitled Event')
-    e.location = event_data.get('location', 'Not specified')
-    e.description = event_data.get('description', 'No description provided.')
+    title = event_data.get('title') or 'Untitled Event'
+    # Placeholders only for missing keys; empty strings leave the property out
+    location = event_data.get('location', 'Not specified')
+    description = event_data.get('description', 'No description provided.')
 
     try:
-        begin_dt = date_parser(event_data['start_time'], default=datetime.now())
+        # Minute-granular default so repeated strings on a flyer share a cache entry
+        now = datetime.now().replace(second=0, microsecond=0)
+        begin_dt = _parse_datetime(event_data['start_time'], default=now)
 
         # Fix year if wrong/missing
         if begin_dt.year != CURRENT_YEAR:
@@ -139,10 +239,10 @@ def create_ics_file(event_data: dict) -> str:
 
     except Exception:
         begin_dt = DEFAULT_TZ.localize(datetime.now().replace(hour=9, minute=0, second=0, microsecond=0))
-        st.warning(f"Could not parse start_time for '{e.name}'. Using default: {begin_dt}")
+        st.warning(f"Could not parse start_time for '{title}'. Using default: {begin_dt}")
 
     try:
-        end_dt = date_parser(event_data['end_time'], default=begin_dt + timedelta(hours=2))
+        end_dt = _parse_datetime(event_data['end_time'], default=begin_dt + timedelta(hours=2))
 
         if end_dt.year != CURRENT_YEAR:
             end_dt = end_dt.replace(year=CURRENT_YEAR)
@@ -152,16 +252,21 @@ def create_ics_file(event_data: dict) -> str:
 
     except Exception:
         end_dt = begin_dt + timedelta(hours=2)
-        st.warning(f"Could not parse end_time for '{e.name}'. Using default: {end_dt}")
-
-    e.begin = begin_dt
-    e.end = end_dt
-    c.events.add(e)
-    return str(c)
+        st.warning(f"Could not parse end_time for '{title}'. Using default: {end_dt}")
+
+    return _ICS_TEMPLATE.format(
+        uid=uuid.uuid4(),
+        stamp=datetime.now(pytz.utc),
+        begin=begin_dt.astimezone(pytz.utc),
+        end=end_dt.astimezone(pytz.utc),
+        summary=_ics_text("SUMMARY", title),
+        location=_ics_text("LOCATION", location),
+        description=_ics_text("DESCRIPTION", description),
+    )
 
 def slugify(text: str) -> str:
-    text = re.sub(r'[^\w\s-]', '', text).strip().lower()
-    text = re.sub(r'[-\s]+', '-', text)
+    text = _SLUG_NONWORD.sub('', text).strip().lower()
+    text = _SLUG_DASH.sub('-', text)
     return text
 
 
@@ -186,13 +291,8 @@ if uploaded_files:
         image = None
         if uploaded_file.type == "application/pdf":
             try:
-                pdf_bytes = uploaded_file.getvalue()
-                pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-                if len(pdf_document) > 0:
-                    page = pdf_document.load_page(0)
-                    pix = page.get_pixmap(dpi=200)
-                    img_bytes = pix.tobytes("png")
-                    image = Image.open(io.BytesIO(img_bytes))
+                image = render_pdf_first_page(uploaded_file.getvalue())
+                if image is not None:
                     st.info("PDF detected. Processing the first page as an image.")
                 else:
                     st.warning(f"PDF file '{uploaded_file.name}' is empty.")
@@ -1,16 +1,28 @@
 import streamlit as st
-from PIL import Image
-from ics import Calendar, Event
-from datetime import datetime, timedelta
+import PIL
+from PIL import ExifTags, Image, ImageOps
+from datetime import datetime, timedelta, timezone
 from dateutil.parser import parse as date_parser
 import json
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # optional speedup; the stdlib parser gives the same result
+    _json_loads = json.loads
 import fitz  # PyMuPDF
 import io
+import logging
 import re
 import anthropic
+import httpx
 import base64
-from collections import defaultdict
+import hashlib
+import uuid
+from collections import OrderedDict
 import zipfile
+from functools import lru_cache, partial
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 
 # --- Page config ---
 st.set_page_config(layout="wide", page_title="Flyer to Calendar", page_icon="📅")
@@ -23,48 +35,146 @@ ANTHROPIC_API_KEY = st.secrets.get("ANTHROPIC_API_KEY", "").strip() or \
     "sk-ant-REPLACE_ME"  # fallback to keep the app runnable if you prefer hard-coding
 
 # Configure the Anthropic API client
-try:
-    client = anthropic.Anthropic(
-        api_key=ANTHROPIC_API_KEY,
-        default_headers={"anthropic-version": "2023-06-01"}
+@st.cache_resource
+def get_anthropic_client(api_key: str) -> anthropic.Anthropic:
+    """One client per process, so reruns keep its pooled HTTP/2 connections warm."""
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+        timeout=httpx.Timeout(60.0, connect=5.0),
     )
+    return anthropic.Anthropic(
+        api_key=api_key,
+        default_headers={"anthropic-version": "2023-06-01"},
+        http_client=http_client,
+    )
+
+
+try:
+    client = get_anthropic_client(ANTHROPIC_API_KEY)
 except Exception as e:
     st.error(f"🔴 Anthropic API Configuration Error: Could not initialize the client. Details: {e}")
     st.stop()
 
 
+# --- Logging & Pillow build ---
+# Pillow-SIMD versions look like 9.5.0.post1
+PILLOW_SIMD = ".post" in PIL.__version__
+
+log = logging.getLogger("flyer2cal")
+if not log.handlers:
+    # Loggers outlive Streamlit reruns, so this block runs once per process: give the app
+    # logger a handler (INFO is dropped otherwise) and note which Pillow encodes the JPEGs
+    log.addHandler(logging.StreamHandler())
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    log.info("Pillow %s (%s build)", PIL.__version__, "SIMD" if PILLOW_SIMD else "stock")
+
+
 # ----------------------------
 # Helpers & Core Functionality
 # ----------------------------
 
-def image_to_base64(image: Image.Image):
-    """Convert PIL Image to base64 and return data + media_type."""
+_SLUG_NONWORD_RE = re.compile(r'[^\w\s-]')
+_SLUG_DASHES_RE = re.compile(r'[-\s]+')
+_JSON_BLOCK_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+MAX_SIDE = 1568  # px; Claude's recommended longest edge, larger images only cost tokens
+PDF_DPI = 150    # plenty for Claude to read flyer text
+
+
+def _has_real_alpha(image: Image.Image) -> bool:
+    """True if the image has transparency that actually hides something."""
+    if image.mode not in ("RGBA", "LA", "PA") and not (image.mode == "P" and "transparency" in image.info):
+        return False
+    return image.convert("RGBA").getchannel("A").getextrema()[0] < 255
+
+
+def image_to_base64(image: Image.Image, max_side: int = MAX_SIDE):
+    """Convert PIL Image to base64 and return data + media_type.
+    Downscales to max_side and sends JPEG q=85 unless the alpha channel matters."""
+    # Phone photos are stored in sensor orientation plus an EXIF tag, which the
+    # re-encode below drops; apply it first (only rotated photos pay for the copy)
+    if image.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+        image = ImageOps.exif_transpose(image)
+
+    if max(image.size) > max_side:
+        # Pillow silently resizes "P" and "1" images with NEAREST whatever filter is
+        # asked for, which breaks up text; resample in RGB(A) instead
+        if image.mode == "P":
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        elif image.mode == "1":
+            image = image.convert("L")
+        # resize() allocates only the small target, unlike copy() + thumbnail()
+        scale = max_side / max(image.size)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.Resampling.LANCZOS)
+
     buffered = io.BytesIO()
-    media_type = ""
-    if image.mode in ("RGBA", "P"):
+    if _has_real_alpha(image):
         image.save(buffered, format="PNG")
         media_type = "image/png"
     else:
-        image.save(buffered, format="JPEG")
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(buffered, format="JPEG", quality=85, optimize=True)
         media_type = "image/jpeg"
-    return base64.b64encode(buffered.getvalue()).decode("utf-8"), media_type
+    # The request body is JSON, so the SDK needs str; encode straight from the buffer (no
+    # getvalue() copy) and decode as ASCII, which is all base64 can contain
+    return base64.b64encode(buffered.getbuffer()).decode("ascii"), media_type
+
+
+@lru_cache(maxsize=1024)
+def _parse_cached(s: str) -> datetime:
+    """Parse a datetime string: ISO-8601 via fromisoformat, anything else via dateutil."""
+    # The prompt asks for ISO-8601, so the C parser usually handles Claude's output
+    try:
+        return datetime.fromisoformat(s)
+    except ValueError:
+        return date_parser(s)
 
 
 def _extract_json_block(text: str):
     """Return first JSON object block in text, else None."""
-    m = re.search(r"\{.*\}", text, re.DOTALL)
+    m = _JSON_BLOCK_RE.search(text)
     return m.group(0) if m else None
 
 
-def get_events_from_flyer(image: Image.Image):
-    """
-    Calls the Anthropic (Claude) API to extract *multiple* events.
-    Returns a list[dict] of events [{title,start_time,end_time,location,description}, ...].
-    """
-    try:
-        img_b64, media_type = image_to_base64(image)
+class FlyerExtractionError(Exception):
+    """Claude answered, but not with usable event JSON. Keeps the raw reply for display."""
+
+    def __init__(self, message: str, response_text: str = ""):
+        super().__init__(message)
+        self.response_text = response_text
+
+
+@dataclass(slots=True)
+class EventRow:
+    """One normalized event. Times are naive (the flyer's wall clock) and already parsed."""
+    title: str
+    start: datetime
+    end: datetime
+    location: str
+    description: str
+    start_disp: str  # e.g. "3:00 PM", formatted once rather than on every rerun
+    end_disp: str
+
+
+_EVENT_GUIDELINES = """
+Guidelines:
+- Create a SEPARATE event for each distinct line/bullet or activity (e.g., if a date lists "Homecoming Carnival, Pep Rally, Out of Uniform" make 3 events).
+- If a line lists multiple grade-specific time slots, create one event per slot and include the grade in the title (e.g., "Pep Rally (PreK–4th)").
+- If the flyer shows a month header like "September" with many dates, use that month for all those dates. If no year is printed, use the current year.
+- If an end time is not present, set it to 2 hours after start_time.
+- If a date range appears without finer granularity (e.g., "Sep 29–30 Book Fair"), create one event per day (00:00 to 23:59:59 each day) with the same title.
+- Use ISO 8601 with seconds (e.g., "2025-09-25T09:00:00").
+- If a location is not specified, set it to "" (empty string).
+- If a description is not specified, set it to "".
 
-        prompt = """
+Do not include any explanation or markdown—only valid JSON.
+"""
+
+EXTRACTION_PROMPT = """
 You are extracting calendar events from a flyer/email screenshot that often lists many dates and times.
 
 Return ONLY a single raw JSON object with this exact top-level schema:
@@ -81,82 +191,193 @@ Return ONLY a single raw JSON object with this exact top-level schema:
     ...
   ]
 }
+""" + _EVENT_GUIDELINES
+
+BATCH_EXTRACTION_PROMPT = """
+You are extracting calendar events from {count} separate flyer/email screenshots (labelled Flyer 1 to Flyer {count} above). Each often lists many dates and times.
+
+Return ONLY a single raw JSON object with this exact top-level schema, with exactly one entry in "flyers" per image, in the same order as the images:
+
+{{
+  "flyers": [
+    {{
+      "events": [
+        {{
+          "title": "...",
+          "start_time": "YYYY-MM-DDTHH:MM:SS",
+          "end_time": "YYYY-MM-DDTHH:MM:SS",
+          "location": "...",
+          "description": "..."
+        }},
+        ...
+      ]
+    }},
+    ...
+  ]
+}}
 
-Guidelines:
-- Create a SEPARATE event for each distinct line/bullet or activity (e.g., if a date lists "Homecoming Carnival, Pep Rally, Out of Uniform" make 3 events).
-- If a line lists multiple grade-specific time slots, create one event per slot and include the grade in the title (e.g., "Pep Rally (PreK–4th)").
-- If the flyer shows a month header like "September" with many dates, use that month for all those dates. If no year is printed, use the current year.
-- If an end time is not present, set it to 2 hours after start_time.
-- If a date range appears without finer granularity (e.g., "Sep 29–30 Book Fair"), create one event per day (00:00 to 23:59:59 each day) with the same title.
-- Use ISO 8601 with seconds (e.g., "2025-09-25T09:00:00").
-- If a location is not specified, set it to "" (empty string).
-- If a description is not specified, set it to "".
+Never mix events from different flyers. If a flyer has no events, give it {{"events": []}}.
+""" + _EVENT_GUIDELINES.replace("{", "{{").replace("}", "}}")
 
-Do not include any explanation or markdown—only valid JSON.
-"""
+MAX_TOKENS_PER_FLYER = 1500
+MODEL_MAX_OUTPUT_TOKENS = 4096  # claude-3-5-sonnet-20240620's output cap
+# Flyers per request: as many full per-flyer budgets as fit in one reply (2)
+BATCH_SIZE = MODEL_MAX_OUTPUT_TOKENS // MAX_TOKENS_PER_FLYER
+# A non-streaming batched reply of ~3k tokens can run past the client's 60s read timeout
+BATCH_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
 
-        response = client.messages.create(
-            # Use your preferred Claude model here
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=1500,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": media_type,
-                                "data": img_b64,
-                            },
-                        },
-                        {"type": "text", "text": prompt}
-                    ],
-                }
-            ],
-        )
-
-        # Anthropic SDK returns a list of content blocks. We expect the first text block to hold JSON.
-        response_text = ""
-        for block in response.content:
-            if getattr(block, "type", None) == "text" and hasattr(block, "text"):
-                response_text += block.text
-
-        json_block = _extract_json_block(response_text)
-        if not json_block:
-            st.error("Could not find a valid JSON object in Claude's response.")
-            st.code(response_text or "[empty response]", language="text")
-            return []
-
-        data = json.loads(json_block)
-
-        # Normalize: handle "events" array OR a single event object fallback
-        if isinstance(data, dict) and "events" in data and isinstance(data["events"], list):
-            events = data["events"]
-        elif isinstance(data, dict):
-            events = [data]  # single event object fallback
-        elif isinstance(data, list):
-            events = data
-        else:
-            events = []
 
-        return _normalize_and_validate_events(events)
+PASSTHROUGH_FORMATS = ("JPEG", "PNG")
+PASSTHROUGH_MAX_BYTES = 1_500_000
+
+
+def _can_pass_through(uploaded_file, image: Image.Image) -> bool:
+    """
+    True if the upload can go to Claude byte-for-byte: a small JPEG/PNG (by the format PIL
+    detected, not the file extension) that isn't EXIF-rotated. Reads only header fields.
+    """
+    return (image.format in PASSTHROUGH_FORMATS
+            and uploaded_file.size <= PASSTHROUGH_MAX_BYTES
+            and max(image.size) <= MAX_SIDE
+            and (image.format != "JPEG" or image.getexif().get(ExifTags.Base.Orientation, 1) == 1))
+
 
+def file_to_claude_payload(uploaded_file, image: Image.Image) -> tuple[str, str]:
+    """
+    Return (base64 data, media_type) for an upload. JPEG/PNG files that are already small
+    enough are sent as uploaded; PDFs and oversized images go through image_to_base64.
+    """
+    if _can_pass_through(uploaded_file, image):
+        return base64.b64encode(uploaded_file.getbuffer()).decode("ascii"), Image.MIME[image.format]
+    return image_to_base64(image)
+
+
+def _image_block(payload: tuple[str, str]) -> dict:
+    img_b64, media_type = payload
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": media_type,
+            "data": img_b64,
+        },
+    }
+
+
+def _response_json(response):
+    """Pull the JSON object out of a messages.create response, or raise FlyerExtractionError."""
+    # Anthropic SDK returns a list of content blocks; for this prompt there's normally one text block
+    texts = [b.text for b in response.content if getattr(b, "type", None) == "text" and hasattr(b, "text")]
+    response_text = texts[0] if len(texts) == 1 else "".join(texts)
+
+    # The prompt asks for raw JSON only, so try that before hunting for a {...} block.
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so one except covers both parsers.
+    try:
+        return _json_loads(response_text), response_text
+    except json.JSONDecodeError:
+        pass
+
+    json_block = _extract_json_block(response_text)
+    if not json_block:
+        raise FlyerExtractionError("Could not find a valid JSON object in Claude's response.", response_text)
+
+    try:
+        return _json_loads(json_block), response_text
     except json.JSONDecodeError as e:
-        st.error(f"Could not parse Claude's response as JSON. Error: {e}")
-        return []
-    except Exception as e:
-        st.error(f"An error occurred while calling the Anthropic API: {e}")
-        return []
+        raise FlyerExtractionError(f"Could not parse Claude's response as JSON. Error: {e}", response_text)
 
 
-def _normalize_and_validate_events(events):
+def _events_from_data(data):
+    # Normalize: handle "events" array OR a single event object fallback
+    if isinstance(data, dict) and "events" in data and isinstance(data["events"], list):
+        events = data["events"]
+    elif isinstance(data, dict):
+        events = [data]  # single event object fallback
+    elif isinstance(data, list):
+        events = data
+    else:
+        events = []
+
+    return _normalize_and_validate_events(events)
+
+
+def get_events_from_flyer(payload: tuple[str, str]):
+    """
+    Calls the Anthropic (Claude) API to extract *multiple* events from one
+    (base64 data, media_type) payload. Returns a list[EventRow], sorted by start.
+    Makes no Streamlit calls so it can run on a worker thread: API errors propagate, and a
+    reply without usable JSON raises FlyerExtractionError for the caller to display.
+    """
+    response = client.messages.create(
+        # Use your preferred Claude model here
+        model="claude-3-5-sonnet-20240620",
+        max_tokens=MAX_TOKENS_PER_FLYER,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    _image_block(payload),
+                    {"type": "text", "text": EXTRACTION_PROMPT}
+                ],
+            }
+        ],
+    )
+    data, _ = _response_json(response)
+    return _events_from_data(data)
+
+
+def get_events_from_flyers_batch(payloads: list[tuple[str, str]]) -> list[list[EventRow]]:
+    """
+    Extracts events from several flyers in one Claude request.
+    Returns one list of events per image, in input order. Raises FlyerExtractionError
+    if the reply was truncated or doesn't line up with the images. API errors aren't
+    retried here; the caller falls back to one request per flyer instead.
+    """
+    content = []
+    for n, payload in enumerate(payloads, start=1):
+        content.append({"type": "text", "text": f"Flyer {n}:"})
+        content.append(_image_block(payload))
+    content.append({"type": "text", "text": BATCH_EXTRACTION_PROMPT.format(count=len(payloads))})
+
+    response = client.with_options(timeout=BATCH_TIMEOUT, max_retries=0).messages.create(
+        model="claude-3-5-sonnet-20240620",
+        max_tokens=min(MAX_TOKENS_PER_FLYER * len(payloads), MODEL_MAX_OUTPUT_TOKENS),
+        messages=[{"role": "user", "content": content}],
+    )
+    if response.stop_reason == "max_tokens":
+        raise FlyerExtractionError("Claude's batched reply was cut off at max_tokens.")
+
+    data, response_text = _response_json(response)
+    flyers = data.get("flyers") if isinstance(data, dict) else None
+    if not isinstance(flyers, list) or len(flyers) != len(payloads):
+        raise FlyerExtractionError("Claude's batched reply doesn't match the uploaded flyers.", response_text)
+    return [_events_from_data(flyer) for flyer in flyers]
+
+
+def extract_events_for_group(flyers: list, executor: ThreadPoolExecutor) -> list:
     """
-    - Ensures required keys exist.
+    Worker for one batch of (uploaded_file, image) pairs. Tries a single batched request;
+    if that fails, each flyer goes back to the executor as its own request so they still
+    run in parallel. Returns, per flyer, its events or a Future for them.
+    """
+    payloads = [file_to_claude_payload(uploaded_file, image) for uploaded_file, image in flyers]
+    if len(payloads) == 1:
+        return [get_events_from_flyer(payloads[0])]
+    try:
+        return get_events_from_flyers_batch(payloads)
+    except (FlyerExtractionError, anthropic.APIError):
+        # Truncated, misaligned, too large or too slow as one request. Submit without
+        # waiting on the results, so this worker never blocks on its own pool.
+        return [executor.submit(get_events_from_flyer, payload) for payload in payloads]
+
+
+def _normalize_and_validate_events(events) -> list[EventRow]:
+    """
+    - Turns Claude's raw event dicts into EventRows, filling missing keys.
     - Fills missing end_time with start_time + 2h.
-    - Coerces all datetimes to ISO strings.
+    - Parses all datetimes once and drops any timezone offset.
     - Drops clearly invalid rows (no parseable start_time).
+    - Returns the rows sorted by start.
     """
     normalized = []
     for i, ev in enumerate(events):
@@ -168,7 +389,8 @@ def _normalize_and_validate_events(events):
         start_dt = None
         if start_raw:
             try:
-                start_dt = date_parser(str(start_raw))
+                # Keep the flyer's wall-clock time; any offset Claude adds is dropped
+                start_dt = _parse_cached(str(start_raw)).replace(tzinfo=None)
             except Exception:
                 start_dt = None
 
@@ -182,7 +404,7 @@ def _normalize_and_validate_events(events):
         end_dt = None
         if end_raw:
             try:
-                end_dt = date_parser(str(end_raw))
+                end_dt = _parse_cached(str(end_raw)).replace(tzinfo=None)
             except Exception:
                 end_dt = None
 
@@ -192,84 +414,142 @@ def _normalize_and_validate_events(events):
         location = str(ev.get("location") or "").strip()
         description = str(ev.get("description") or "").strip()
 
-        normalized.append({
-            "title": title,
-            "start_time": start_dt.strftime("%Y-%m-%dT%H:%M:%S"),
-            "end_time": end_dt.strftime("%Y-%m-%dT%H:%M:%S"),
-            "location": location,
-            "description": description,
-        })
+        normalized.append(EventRow(
+            title=title,
+            start=start_dt,
+            end=end_dt,
+            location=location,
+            description=description,
+            start_disp=start_dt.strftime("%-I:%M %p"),
+            end_disp=end_dt.strftime("%-I:%M %p"),
+        ))
+    # Sort once here so grouping and rendering never have to
+    normalized.sort(key=lambda e: e.start)
     return normalized
 
 
-def create_ics_for_event(event_data: dict) -> str:
+_ICS_HEADER = "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//flyer2cal//EN\r\n"
+_ICS_FOOTER = "END:VCALENDAR\r\n"
+_ICS_ESCAPES = str.maketrans({"\\": "\\\\", ",": "\\,", ";": "\\;", "\n": "\\n", "\r": ""})
+
+
+def _ics_line(name: str, value: str) -> str:
+    """One content line, folded at 75 octets (RFC 5545 3.1) without splitting a UTF-8 sequence."""
+    raw = f"{name}:{value}".encode("utf-8")
+    parts, limit = [], 75
+    while len(raw) > limit:
+        cut = limit
+        while (raw[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(raw[:cut].decode("utf-8"))
+        raw = raw[cut:]
+        limit = 74  # continuation lines start with a space
+    parts.append(raw.decode("utf-8"))
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def _format_event(ev: EventRow) -> str:
+    """Serialize one normalized event as a VEVENT block."""
+    lines = [
+        "BEGIN:VEVENT\r\n",
+        f"UID:{uuid.uuid4()}@flyer2cal\r\n",
+        f"DTSTAMP:{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}\r\n",
+        # Normalized times are naive, so they go out floating (the flyer's local time)
+        f"DTSTART:{ev.start:%Y%m%dT%H%M%S}\r\n",
+        f"DTEND:{ev.end:%Y%m%dT%H%M%S}\r\n",
+        _ics_line("SUMMARY", ev.title.translate(_ICS_ESCAPES)),
+    ]
+    if ev.location:
+        lines.append(_ics_line("LOCATION", ev.location.translate(_ICS_ESCAPES)))
+    if ev.description:
+        lines.append(_ics_line("DESCRIPTION", ev.description.translate(_ICS_ESCAPES)))
+    lines.append("END:VEVENT\r\n")
+    return "".join(lines)
+
+
+def create_ics_for_event(ev: EventRow) -> str:
     """Create a single-event .ics string."""
-    c = Calendar()
-    e = Event()
-    e.name = event_data.get('title', 'Untitled Event')
-    e.location = event_data.get('location', '')
-    e.description = event_data.get('description', '')
-    try:
-        e.begin = date_parser(event_data['start_time'])
-        e.end = date_parser(event_data['end_time'])
-    except Exception as err:
-        # As last resort, put now..now+2h so file is still valid
-        st.warning(f"Could not parse date/time for '{e.name}'. Using default times. Error: {err}")
-        now = datetime.now()
-        e.begin, e.end = now, now + timedelta(hours=2)
-    c.events.add(e)
-    return str(c)
-
-
-def create_ics_for_many(events: list[dict]) -> str:
+    return _ICS_HEADER + _format_event(ev) + _ICS_FOOTER
+
+
+def create_ics_for_many(events: list[EventRow]) -> str:
     """Create a combined .ics string with all events."""
-    c = Calendar()
-    for ev in events:
-        e = Event()
-        e.name = ev.get('title', 'Untitled Event')
-        e.location = ev.get('location', '')
-        e.description = ev.get('description', '')
-        try:
-            e.begin = date_parser(ev['start_time'])
-            e.end = date_parser(ev['end_time'])
-        except Exception:
-            # Skip any broken entries in the combined file to avoid corrupting the ICS
-            continue
-        c.events.add(e)
-    return str(c)
+    return _ICS_HEADER + "".join(_format_event(ev) for ev in events) + _ICS_FOOTER
 
 
 def slugify(text: str) -> str:
-    text = re.sub(r'[^\w\s-]', '', text).strip().lower()
-    text = re.sub(r'[-\s]+', '-', text)
+    text = _SLUG_NONWORD_RE.sub('', text).strip().lower()
+    text = _SLUG_DASHES_RE.sub('-', text)
     return text or "event"
 
 
-def group_events_by_date(events: list[dict]):
-    """Group events by start date (YYYY-MM-DD)."""
-    buckets = defaultdict(list)
+def group_events_by_date(events: list[EventRow]) -> dict[str, tuple[str, list[EventRow]]]:
+    """
+    Group events by start date: {YYYY-MM-DD: (pretty heading, events)}.
+    Expects events already sorted by start (as _normalize_and_validate_events returns
+    them), so groups and the events inside them come out in order without re-sorting.
+    """
+    buckets = {}
     for ev in events:
-        try:
-            d = date_parser(ev["start_time"]).date()
-            buckets[d.isoformat()].append(ev)
-        except Exception:
-            buckets["unknown-date"].append(ev)
-    # Sort groups by actual date key
-    return dict(sorted(buckets.items(), key=lambda kv: kv[0]))
+        d = ev.start.date()
+        key = d.isoformat()
+        if key not in buckets:
+            buckets[key] = (d.strftime("%A, %B %d, %Y"), [])
+        buckets[key][1].append(ev)
+    return buckets
 
 
-def build_zip_of_individual_ics(events: list[dict], base_name: str) -> bytes:
+def build_zip_of_individual_ics(events: list[EventRow], base_name: str) -> bytes:
     """Return a .zip (as bytes) that contains one .ics per event."""
     mem_buf = io.BytesIO()
-    with zipfile.ZipFile(mem_buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+    # .ics files are a few hundred bytes each; deflating them isn't worth the CPU
+    with zipfile.ZipFile(mem_buf, "w", compression=zipfile.ZIP_STORED) as zf:
         for ev in events:
             ics = create_ics_for_event(ev)
-            fname = f"{slugify(base_name)}-{slugify(ev['title'])}.ics"
+            fname = f"{slugify(base_name)}-{slugify(ev.title)}.ics"
             zf.writestr(fname, ics)
     mem_buf.seek(0)
     return mem_buf.read()
 
 
+EVENTS_CACHE_SIZE = 64
+
+
+@st.cache_resource
+def _events_cache() -> OrderedDict:
+    """Process-wide {blake2b of upload: events}, so reruns don't send the same flyer to Claude again."""
+    return OrderedDict()
+
+
+def _remember_events(cache: OrderedDict, key: str, events: list[EventRow]):
+    if events:  # an empty result is more likely a bad read than an empty flyer; retry it next run
+        cache[key] = events
+        while len(cache) > EVENTS_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def load_flyer_image(uploaded_file) -> Image.Image | None:
+    """
+    Opens an upload as a PIL image (first page for PDFs). Returns None for an empty PDF;
+    decode errors propagate. Call from the main thread only: PyMuPDF isn't thread-safe.
+    """
+    if uploaded_file.type == "application/pdf":
+        # The with-block frees the native document as soon as page 0 is rasterized
+        with fitz.open(stream=uploaded_file.getvalue(), filetype="pdf") as pdf_document:
+            if pdf_document.page_count == 0:
+                return None
+            page = pdf_document[0]
+            # Wrap the raw RGB samples directly rather than round-tripping through PNG
+            pix = page.get_pixmap(dpi=PDF_DPI, alpha=False, clip=page.rect)
+            return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    image = Image.open(uploaded_file)
+    # Anything a worker will re-encode is decoded now, not lazily on whichever thread
+    # touches it first. Pass-through uploads are never decoded off the main thread.
+    if not _can_pass_through(uploaded_file, image):
+        image.load()
+    return image
+
+
 # ----------------------------
 # Streamlit UI
 # ----------------------------
@@ -289,43 +569,79 @@ uploaded_files = st.file_uploader(
 if uploaded_files:
     st.divider()
 
+# Decode every upload first (PyMuPDF isn't thread-safe, so this stays on the main
+# thread), then fan the Claude calls out to a pool; results still render in upload order.
+jobs = []
+seen_ids = {}
 for uploaded_file in uploaded_files or []:
+    # Content hash, computed once: keys the events cache and every widget for this file
+    file_id = hashlib.blake2b(uploaded_file.getvalue(), digest_size=8).hexdigest()
+    seen_ids[file_id] = seen_ids.get(file_id, -1) + 1
+    widget_id = f"{file_id}-{seen_ids[file_id]}" if seen_ids[file_id] else file_id  # same file uploaded twice
+
+    image, load_error = None, None
+    try:
+        image = load_flyer_image(uploaded_file)
+    except Exception as e:
+        load_error = e
+    jobs.append((uploaded_file, file_id, widget_id, image, load_error))
+
+# Batch flyers we haven't already read into groups so each request carries several images.
+# Each distinct file goes to Claude once; a duplicate upload shares the first copy's result.
+events_cache = _events_cache()
+ready, queued_ids = [], set()
+for i, (_, file_id, _, image, _) in enumerate(jobs):
+    if image and file_id not in events_cache and file_id not in queued_ids:
+        queued_ids.add(file_id)
+        ready.append(i)
+groups = [ready[i:i + BATCH_SIZE] for i in range(0, len(ready), BATCH_SIZE)]
+
+# Sized per flyer, not per group: a failed batch hands each flyer back as its own request
+executor = ThreadPoolExecutor(max_workers=max(1, min(8, len(ready))))
+futures = {}
+for group in groups:
+    future = executor.submit(extract_events_for_group, [(jobs[i][0], jobs[i][3]) for i in group], executor)
+    for pos, i in enumerate(group):
+        futures[jobs[i][1]] = (future, pos)  # keyed by file_id
+
+for (uploaded_file, file_id, widget_id, image, load_error) in jobs:
     st.header(f"Processing: `{uploaded_file.name}`")
+    is_pdf = uploaded_file.type == "application/pdf"
 
-    image = None
-    if uploaded_file.type == "application/pdf":
-        try:
-            pdf_bytes = uploaded_file.getvalue()
-            pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-            if len(pdf_document) > 0:
-                page = pdf_document.load_page(0)
-                pix = page.get_pixmap(dpi=200)
-                img_bytes = pix.tobytes("png")
-                image = Image.open(io.BytesIO(img_bytes))
-                st.info("PDF detected. Processing the first page as an image.")
-            else:
-                st.warning(f"PDF file '{uploaded_file.name}' is empty.")
-                st.divider()
-                continue
-        except Exception as e:
-            st.error(f"Failed to process PDF file '{uploaded_file.name}': {e}")
-            st.divider()
-            continue
-    else:
-        try:
-            image = Image.open(uploaded_file)
-        except Exception as e:
-            st.error(f"Failed to open image file '{uploaded_file.name}': {e}")
+    if load_error is not None:
+        if is_pdf:
+            st.error(f"Failed to process PDF file '{uploaded_file.name}': {load_error}")
+        else:
+            st.error(f"Failed to open image file '{uploaded_file.name}': {load_error}")
+        st.divider()
+        continue
+
+    if is_pdf:
+        if image is None:
+            st.warning(f"PDF file '{uploaded_file.name}' is empty.")
             st.divider()
             continue
+        st.info("PDF detected. Processing the first page as an image.")
 
     if not image:
         st.error("No image could be read.")
         st.divider()
         continue
 
-    with st.spinner("🤖 Claude is analyzing the flyer…"):
-        events = get_events_from_flyer(image)
+    events = events_cache.get(file_id, [])
+    if file_id in futures:
+        with st.spinner("🤖 Claude is analyzing the flyer…"):
+            try:
+                future, pos = futures[file_id]
+                events = future.result()[pos]
+                if isinstance(events, Future):
+                    events = events.result()  # the batch failed; this flyer went on its own
+                _remember_events(events_cache, file_id, events)
+            except FlyerExtractionError as e:
+                st.error(str(e))
+                st.code(e.response_text or "[empty response]", language="text")
+            except Exception as e:
+                st.error(f"An error occurred while calling the Anthropic API: {e}")
 
     if not events:
         st.error("No events found for this file.")
@@ -342,66 +658,62 @@ for uploaded_file in uploaded_files or []:
         st.success(f"✅ Found {len(events)} event(s)")
         # Group by date for a neat overview
         grouped = group_events_by_date(events)
-        for date_key, items in grouped.items():
-            try:
-                pretty = date_parser(date_key).strftime("%A, %B %d, %Y")
-            except Exception:
-                pretty = date_key
+        for date_key, (pretty, items) in grouped.items():
             with st.expander(pretty, expanded=True):
-                for idx, ev in enumerate(sorted(items, key=lambda e: e["start_time"])):
-                    start_disp = date_parser(ev["start_time"]).strftime("%-I:%M %p")
-                    end_disp = date_parser(ev["end_time"]).strftime("%-I:%M %p")
-                    st.markdown(f"**{ev['title']}**  —  {start_disp}–{end_disp}")
-                    if ev.get("location"):
-                        st.write(f"📍 {ev['location']}")
-                    if ev.get("description"):
-                        st.caption(ev["description"])
+                for idx, ev in enumerate(items):
+                    st.markdown(f"**{ev.title}**  —  {ev.start_disp}–{ev.end_disp}")
+                    if ev.location:
+                        st.write(f"📍 {ev.location}")
+                    if ev.description:
+                        st.caption(ev.description)
 
                     # Per-event .ics download
                     try:
                         ics_content = create_ics_for_event(ev)
-                        file_name = f"{slugify(ev['title'])}.ics"
+                        file_name = f"{slugify(ev.title)}.ics"
                         st.download_button(
                             label="📅 Download invite (.ics)",
                             data=ics_content,
                             file_name=file_name,
                             mime="text/calendar",
                             use_container_width=True,
-                            key=f"{uploaded_file.name}-{date_key}-{idx}"
+                            key=f"{widget_id}-{date_key}-{idx}"
                         )
                     except Exception as e:
-                        st.error(f"Could not generate .ics for '{ev['title']}': {e}")
+                        st.error(f"Could not generate .ics for '{ev.title}': {e}")
                     st.markdown("---")
 
         # Combined downloads (all events from this flyer)
         st.subheader("Bulk downloads for this flyer")
         try:
-            combined_ics = create_ics_for_many(events)
+            # Built only when clicked; partial binds this flyer's events, not the loop's last
             st.download_button(
                 "📥 Download ALL in one .ics (adds every event)",
-                data=combined_ics,
+                data=partial(create_ics_for_many, events),
                 file_name=f"{slugify(uploaded_file.name)}-all-events.ics",
                 mime="text/calendar",
                 use_container_width=True,
-                key=f"combined-{uploaded_file.name}"
+                key=f"combined-{widget_id}"
             )
         except Exception as e:
             st.error(f"Could not create combined .ics: {e}")
 
         try:
-            zipped = build_zip_of_individual_ics(events, base_name=uploaded_file.name)
             st.download_button(
                 "🗂️ Download a .zip of individual .ics files",
-                data=zipped,
+                data=partial(build_zip_of_individual_ics, events, base_name=uploaded_file.name),
                 file_name=f"{slugify(uploaded_file.name)}-events.zip",
                 mime="application/zip",
                 use_container_width=True,
-                key=f"zip-{uploaded_file.name}"
+                key=f"zip-{widget_id}"
             )
         except Exception as e:
             st.error(f"Could not build .zip: {e}")
 
     st.divider()
 
+# Every group has finished (and handed off any fallbacks) by now, so nothing more is submitted
+executor.shutdown(wait=False)
+
 if not uploaded_files:
     st.info("Upload a flyer to get started.")